@@ -11,8 +11,9 @@ Existing page numbers will not be preserved.
 '''
 
 import argparse
+import operator
 import os
-import shutil
+import sys
 
 def renameChapter(basePath, interactive):
     basePath = os.path.abspath(basePath)
@@ -22,22 +23,28 @@ def renameChapter(basePath, interactive):
 
     baseName = os.path.basename(basePath)
 
+    with os.scandir(basePath) as it:
+        entries = sorted(it, key = operator.attrgetter('name'))
+
     renames = []
-    for dirent in sorted(os.listdir(basePath)):
-        pagePath = os.path.join(basePath, dirent)
-        if (not os.path.isfile(pagePath)):
-            print("ERROR: Specified directory contains something that is not a file: '%s'." % (pagePath))
+    for entry in entries:
+        if (not entry.is_file()):
+            print("ERROR: Specified directory contains something that is not a file: '%s'." % (entry.path))
 
-        ext = os.path.splitext(dirent)[-1]
+        ext = os.path.splitext(entry.name)[-1]
 
-        renames.append((dirent, "%s p%03d%s" % (baseName, len(renames) + 1, ext)))
+        renames.append((entry.name, f"{baseName} p{len(renames) + 1:03d}{ext}"))
 
     commit = True
 
     if (interactive):
-        print(basePath)
+        lines = [basePath]
         for (original, rename) in renames:
-            print("    '%s' -> '%s'" % (original, rename))
+            lines.append(f"    '{original}' -> '{rename}'")
+
+        lines.append('')
+        sys.stdout.write('\n'.join(lines))
+        sys.stdout.flush()
 
         response = input('Do rename? (Y / N): ').lower()
         if (response.startswith('y')):
@@ -53,7 +60,7 @@ def renameChapter(basePath, interactive):
             originalPath = os.path.join(basePath, original)
             newPath = os.path.join(basePath, rename)
 
-            shutil.move(originalPath, newPath)
+            os.replace(originalPath, newPath)
 
     return True
 
@@ -2,9 +2,10 @@
 
 import argparse
 import cmd
+import functools
+import operator
 import os
 import re
-import shutil
 import sys
 
 DIRECTORY_REGEX   = re.compile(r'^(.+) v(\d{3}) c(\d{3}[a-z]?)$')
@@ -13,8 +14,12 @@ PAGE_REGEX        = re.compile(r'^(.+) v(\d{3}) c(\d{3}[a-z]?) p(\d{3}(?:-\d{3})
 
 NUMBER_REGEX = re.compile(r'((\d+)(?:-(\d+))?([a-z])?)')
 
+INTEGER_REGEX = re.compile(r'^\d+$')
+
 CHECKMARK = '✓'
 
+TEMP_NAME_FORMAT = '.manga-rename.tmp.%d'
+
 ACTION_RENAME = 'R'
 ACTION_IGNORE = 'I'
 ACTION_DELETE = 'D'
@@ -23,6 +28,53 @@ TYPE_NONE = 'None'
 TYPE_SERIES = 'Series'
 TYPE_CHAPTER = 'Chapter'
 
+# Take in some text that is supposed to be a page number and return a padded version.
+# Note that "page numbers" are not just digits, they can have a dash and letters.
+# This is pure and called for every entry on every reload, so results are cached.
+@functools.lru_cache(maxsize = 4096)
+def _parseAndPad(text):
+    text = str(text).strip()
+
+    # Plain numbers (including every backup number) don't need the regex.
+    if (text.isascii() and text.isdigit()):
+        number = int(text)
+        return f"{number:03d}", number
+
+    match = NUMBER_REGEX.match(text)
+    if (match is None):
+        return None, None
+
+    number = int(match.group(2))
+    text = f"{number:03d}"
+    highestNumber = number
+
+    if (match.group(3) is not None):
+        number = int(match.group(3))
+        text += f"-{number:03d}"
+
+        if (number > highestNumber):
+            highestNumber = number
+
+    if (match.group(4) is not None):
+        text += match.group(4)
+
+    return text, highestNumber
+
+# Find the (padded) number in an entry's name, or None if the pattern does not match.
+# The regex should pull out the number in the first capture group.
+# Keyed on the name itself (not the file), so a renamed entry is always parsed fresh.
+@functools.lru_cache(maxsize = 10000)
+def _findNumber(name, numberRegex):
+    # Only the last match is used, so don't build a list of all of them.
+    lastMatch = None
+    for lastMatch in numberRegex.finditer(name):
+        pass
+
+    if (lastMatch is None):
+        return None
+
+    return _parseAndPad(lastMatch.group(1))
+
 class RenameShell(cmd.Cmd):
     def __init__(self, basePath):
         super().__init__()
@@ -31,7 +83,10 @@ class RenameShell(cmd.Cmd):
         self.baseName = os.path.basename(self.basePath)
         self.dirType = TYPE_NONE
 
-        self.renames = []
+        # Parallel lists, one element per directory entry.
+        self.entries = []
+        self.originals = []
+        self.newNames = []
         self.actions = []
 
         self.intro = "Editing directory '%s'. Type 'help' or '?' for help." % (self.basePath)
@@ -42,19 +97,31 @@ class RenameShell(cmd.Cmd):
     def do_bulk(self, arg):
         pattern = arg.strip()
         if (pattern == ''):
-            pattern = None
+            self._reload(numberRegex = None)
+            return
+
+        # Compile once here instead of once per entry in _reload().
+        try:
+            numberRegex = re.compile(pattern)
+        except re.error as ex:
+            print("ERROR: Bad pattern '%s': %s." % (pattern, ex))
+            return
 
-        self._reload(numberRegex = pattern)
+        if (numberRegex.groups < 1):
+            print("ERROR: Pattern '%s' does not have a capture group." % (pattern))
+            return
+
+        self._reload(numberRegex = numberRegex)
 
     def do_cd(self, arg):
         arg = arg.strip()
         path = None
 
-        if (re.match(r'^\d+$', arg)):
+        if (INTEGER_REGEX.match(arg)):
             index, _ = self._parseIndex(arg)
             if (index == None):
                 return
-            path = os.path.join(self.basePath, self.renames[index][0])
+            path = os.path.join(self.basePath, self.originals[index])
         else:
             path = arg
             if (not os.path.isabs(path)):
@@ -84,9 +151,9 @@ class RenameShell(cmd.Cmd):
             print('ERROR: No new name specified.')
             return
 
-        print("Editing rename index %d: '%s' -> '%s'." % (index, self.renames[index][1], arg))
+        print("Editing rename index %d: '%s' -> '%s'." % (index, self.newNames[index], arg))
         self.actions[index] = ACTION_RENAME
-        self.renames[index][1] = arg
+        self.newNames[index] = arg
 
     def do_ignore(self, arg):
         index, arg = self._parseIndex(arg)
@@ -116,20 +183,22 @@ class RenameShell(cmd.Cmd):
         print('write    - Write all the renames to disk and quit interactive mode.')
 
     def do_ls(self, arg):
-        print("%s (Type: %s)" % (self.basePath, self.dirType))
+        # Build the whole listing and write it once, instead of a print (and flush) per entry.
+        lines = ["%s (Type: %s)" % (self.basePath, self.dirType)]
+        append = lines.append
 
-        for i in range(len(self.renames)):
-            action = self.actions[i]
-            original, newName = self.renames[i]
+        rows = zip(self.actions, self.originals, self.newNames)
+        for (i, (action, original, newName)) in enumerate(rows):
+            if (action != ACTION_RENAME):
+                append(f"    {i:03d} ({action}) '{original}'")
+                continue
 
-            if (action == ACTION_RENAME):
-                mark = action
-                if (original == newName):
-                    mark = CHECKMARK
+            mark = CHECKMARK if (original == newName) else action
+            append(f"    {i:03d} ({mark}) '{original}' -> '{newName}'")
 
-                print("    %03d (%s) '%s' -> '%s'" % (i, mark, original, newName))
-            else:
-                print("    %03d (%s) '%s'" % (i, action, original))
+        lines.append('')
+        sys.stdout.write('\n'.join(lines))
+        sys.stdout.flush()
 
     def do_quit(self, arg):
         print('Quitting without writting renames.')
@@ -144,7 +213,7 @@ class RenameShell(cmd.Cmd):
         if (index is None):
             return
 
-        path = os.path.join(self.basePath, self.renames[index][0])
+        path = os.path.join(self.basePath, self.originals[index])
 
         print("Index %d (%s) marked for delete." % (index, path))
         self.actions[index] = ACTION_DELETE
@@ -167,7 +236,9 @@ class RenameShell(cmd.Cmd):
         self.dirType = newType
 
     def do_write(self, arg):
-        self._commit()
+        if (not self._commit()):
+            return
+
         self._reload()
         print('Renames committed to disk.')
 
@@ -178,107 +249,203 @@ class RenameShell(cmd.Cmd):
         return line.strip()
 
     # Write actions to disk.
+    # Returns False (and touches nothing) if the renames would clobber an entry.
     def _commit(self):
-        for i in range(len(self.renames)):
-            action = self.actions[i]
-            original, newName = self.renames[i]
+        # Only needed when writing, and slow enough to import that startup should not pay for it.
+        import concurrent.futures
+
+        # Ends in exactly one separator (even for the root).
+        prefix = os.path.join(self.basePath, '')
+
+        renames = []
+        deletes = []
+        stayingNames = set()
 
-            originalPath = os.path.join(self.basePath, original)
-            newPath = os.path.join(self.basePath, newName)
+        # Bound once, these are hit for every entry.
+        addRename = renames.append
+        addDelete = deletes.append
+        addStaying = stayingNames.add
 
+        rows = zip(self.entries, self.actions, self.originals, self.newNames)
+        for (entry, action, original, newName) in rows:
             if (action == ACTION_RENAME and original != newName):
-                shutil.move(originalPath, newPath)
+                addRename((original, newName))
             elif (action == ACTION_DELETE):
-                self._remove(originalPath)
+                addDelete(entry)
+            else:
+                addStaying(original)
+
+        targets = set()
+        for (original, newName) in renames:
+            if (newName in targets or newName in stayingNames):
+                print("ERROR: More than one entry would end up named '%s', nothing written." % (newName))
+                return False
+
+            targets.add(newName)
+
+        # Every delete and rename is a single syscall that releases the GIL,
+        # so independent ones are overlapped on a thread pool.
+        entryNames = set(self.originals)
+        batches = self._orderRenames(renames, entryNames | targets)
+
+        # Temp name -> the name it is supposed to end up with.
+        # Any rename source that was not loaded from disk is a temp name.
+        tempTargets = {}
+        for batch in batches:
+            for (original, newName) in batch:
+                if (original not in entryNames):
+                    tempTargets[original] = newName
+
+        workers = min(32, (os.cpu_count() or 1) * 2)
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers = workers) as executor:
+                # Deletes go first so that renaming onto a deleted entry's name is safe.
+                list(executor.map(self._remove, deletes))
+
+                for batch in batches:
+                    sources = [prefix + original for (original, newName) in batch]
+                    destinations = [prefix + newName for (original, newName) in batch]
+                    list(executor.map(os.replace, sources, destinations))
+        except OSError as ex:
+            print("ERROR: Failed to write renames, directory is partially renamed: %s." % (ex))
+
+            # Don't lose track of anything that was stashed under a temp name.
+            for (tempName, newName) in tempTargets.items():
+                if (os.path.lexists(prefix + tempName)):
+                    print("    '%s' should be renamed to '%s'." % (tempName, newName))
+
+            return False
+
+        return True
+
+    # Split renames into batches so that nothing is ever moved onto a name that has not been moved away yet.
+    # Renames within a batch never touch each other's names, so they can run in any order (or at once).
+    # Targets are unique, so the renames only form chains and cycles.
+    # Chains are done back to front, and each cycle is broken by moving one of its entries to a temp name.
+    def _orderRenames(self, renames, takenNames):
+        pending = dict(renames)
+        ready = [original for (original, newName) in renames if newName not in pending]
+
+        # Name -> the rename that is waiting for that name to be vacated.
+        blocked = {newName: original for (original, newName) in renames if newName in pending}
+
+        batches = []
+        tempCount = 0
+
+        while (len(pending) > 0):
+            batch = []
+
+            if (len(ready) > 0):
+                for original in ready:
+                    batch.append((original, pending.pop(original)))
+                ready = []
+            else:
+                # Everything left is in a cycle, stash one entry from each cycle.
+                visited = set()
+                for original in list(pending):
+                    if (original in visited):
+                        continue
+
+                    name = original
+                    while (name not in visited):
+                        visited.add(name)
+                        name = pending[name]
+
+                    tempName = TEMP_NAME_FORMAT % (tempCount)
+                    while (tempName in takenNames):
+                        tempCount += 1
+                        tempName = TEMP_NAME_FORMAT % (tempCount)
+                    takenNames.add(tempName)
+
+                    pending[tempName] = pending.pop(original)
+                    blocked[pending[tempName]] = tempName
+                    batch.append((original, tempName))
+
+            for (original, newName) in batch:
+                if (original in blocked):
+                    ready.append(blocked.pop(original))
+
+            batches.append(batch)
+
+        return batches
 
     # The regex should pull out the number in the first capture group.
     def _createRename(self, original, backupNumber, numberRegex):
-        ext = os.path.splitext(original)[-1]
-
-        number, highestNumber = self._parseAndPad(backupNumber)
+        number, highestNumber = _parseAndPad(backupNumber)
 
         if (numberRegex is not None):
-            matches = re.findall(numberRegex, original)
-            if (matches is not None and len(matches) > 0):
-                number, highestNumber = self._parseAndPad(matches[-1][0])
+            parsed = _findNumber(original, numberRegex)
+            if (parsed is not None):
+                number, highestNumber = parsed
 
         if (number is None):
             return original, backupNumber
 
         if (self.dirType == TYPE_NONE):
             return original, highestNumber
-        elif (self.dirType == TYPE_SERIES):
-            return "%s c%s%s" % (self.baseName, number, ext), highestNumber
+
+        ext = os.path.splitext(original)[-1]
+
+        if (self.dirType == TYPE_SERIES):
+            return f"{self.baseName} c{number}{ext}", highestNumber
         elif (self.dirType == TYPE_CHAPTER):
-            return "%s p%s%s" % (self.baseName, number, ext), highestNumber
+            return f"{self.baseName} p{number}{ext}", highestNumber
         else:
             raise ValueError("Unknown directory type: %s." % (self.dirType))
 
-    # Take in some text that is supposed to be a page number and return a padded version.
-    # Note that "page numbers" are not just digits, they can have a dash and letters.
-    def _parseAndPad(self, text):
-        text = str(text).strip()
-
-        match = NUMBER_REGEX.match(text)
-        if (match is None):
-            return None, None
-
-        number = int(match.group(2))
-        text = "%03d" % (number)
-        highestNumber = number
-
-        if (match.group(3) is not None):
-            number = int(match.group(3))
-            text += "-%03d" % (number)
-
-            if (number > highestNumber):
-                highestNumber = number
-
-        if (match.group(4) is not None):
-            text += match.group(4)
-
-        return text, highestNumber
-
     def _parseIndex(self, arg):
         arg = str(arg).strip()
 
-        match = re.match(r'^(-?\d+)\s*.*$', arg)
-        if (match is None):
+        # The index is the first word, and must be an (optionally negative) run of decimal digits.
+        # int() alone would also take things like '+1' or '1_0', and an index glued to text ('3foo') is not an index.
+        parts = arg.split(None, 1)
+        digits = parts[0].removeprefix('-') if (len(parts) > 0) else ''
+        if (not digits.isdecimal()):
             print('ERROR: Expecting index.')
             return (None, arg)
 
-        index = int(match.group(1))
-        arg = arg.removeprefix(match.group(1)).strip()
+        index = int(parts[0])
+        arg = parts[1] if (len(parts) > 1) else ''
 
-        if (index < 0 or index >= len(self.renames)):
-            print("ERROR: Index (%d) out of range [0, %d)." % (index, len(self.renames)))
+        if (index < 0 or index >= len(self.originals)):
+            print("ERROR: Index (%d) out of range [0, %d)." % (index, len(self.originals)))
             return (None, arg)
 
-        if (self.renames[index] is None):
+        if (self.newNames[index] is None):
             print('ERROR: Index %d is ignored.' % (index))
             return (None, arg)
 
         return (index, arg)
 
     def _reload(self, numberRegex = NUMBER_REGEX):
-        self.renames = []
+        # DirEntry objects carry the file type from the directory read,
+        # so later checks (e.g. in _remove()) do not need another stat.
+        with os.scandir(self.basePath) as it:
+            self.entries = sorted(it, key = operator.attrgetter('name'))
+
+        self.originals = [entry.name for entry in self.entries]
+        self.newNames = []
         nextNumber = 1
 
-        for dirent in sorted(os.listdir(self.basePath)):
-            rename, highestNumber = self._createRename(dirent, nextNumber, numberRegex)
+        createRename = self._createRename
+        addNewName = self.newNames.append
+
+        for original in self.originals:
+            rename, highestNumber = createRename(original, nextNumber, numberRegex)
             nextNumber = max(nextNumber, highestNumber) + 1
 
-            self.renames.append([dirent, rename])
+            addNewName(rename)
 
-        self.actions = [ACTION_RENAME] * len(self.renames)
+        self.actions = [ACTION_RENAME] * len(self.originals)
 
-    def _remove(self, path):
-        if (os.path.isfile(path) or os.path.islink(path)):
-            os.remove(path)
-        elif os.path.isdir(path):
-            shutil.rmtree(path)
+    def _remove(self, entry):
+        if (entry.is_file() or entry.is_symlink()):
+            os.remove(entry.path)
+        elif entry.is_dir():
+            import shutil
+            shutil.rmtree(entry.path)
         else:
-            raise ValueError("Path %s is not a file, link, or dir." % (path))
+            raise ValueError("Path %s is not a file, link, or dir." % (entry.path))
 
 def main(args):
     RenameShell(args.path[0]).cmdloop()